@@ -56,11 +56,12 @@ import typing
 
 from pathlib import Path
 import enum
-import inspect
 import traceback
 import multiprocessing
+import multiprocessing.util
 import threading
-import queue
+import collections
+import atexit
 
 import sqlite3
 
@@ -88,14 +89,43 @@ _DSS_LOG_FILE = os.path.join(_DSS_LOG_DIR, 'lg36.db')
 
 # ******************** additional options.
 
+# "NORMAL" or "OFF". With WAL, NORMAL only syncs at checkpoints and survives an app crash (only a power loss or OS
+# crash can lose the last few transactions). OFF never syncs, it is slightly faster but an OS crash can corrupt the db.
+_DSS_DURABILITY = "NORMAL"
+
 _SQLITE_PRAGMAS = [
 
-    # if sqlite performance is poor, dont change isolation_level=None (autocommit essentially),
-    # instead disable synchronous writes. I believe its issuing a sync syscall after each transaction.
-    # I once measured 2 seconds to flush ~ 500 msgs if this is left ON.
-    "PRAGMA synchronous = OFF"
+    # if sqlite performance is poor, relax synchronous writes. I believe its issuing a sync syscall after each
+    # transaction.
+    # I once measured 2 seconds to flush ~ 500 msgs if this is left at FULL.
+    f"PRAGMA synchronous = {_DSS_DURABILITY}",
+
+    # temp tables and indices in ram, bigger page cache (negative means KiB, so 64 MiB), memory map up to 256 MiB of
+    # the db file, and wait up to 5 seconds instead of failing right away if the db is locked (i.e. by a reader).
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -65536",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA busy_timeout = 5000",
 ]
 
+# WAL lets readers (i.e. dump_lg36) run concurrently with the DSS writes, but it needs a real file.
+if _DSS_LOG_FILE != ':memory:':
+    _SQLITE_PRAGMAS.insert(0, "PRAGMA journal_mode = WAL")
+
+# DSS batches log records into a single transaction instead of one INSERT per record. A batch is committed once it
+# reaches _DSS_MAX_BATCH_SIZE records, once the dss queue has been quiet for _DSS_DRAIN_WAIT_SEC, or once the oldest
+# record in it has been waiting for _DSS_MAX_COMMIT_INTERVAL_SEC, whichever comes first.
+# The stdout sink is also written from the dss thread, in one write per batch. So lg36 output can show up a little
+# after a plain print() that was issued later, call flush_curr_thread() first if the order matters.
+# WARN and above are not held back, those (and any stdout lines pending ahead of them) are written to stdout as soon
+# as dss sees them, a crash right after an error should not take the error line with it.
+_DSS_MAX_BATCH_SIZE = 500
+_DSS_DRAIN_WAIT_SEC = 0.05
+_DSS_MAX_COMMIT_INTERVAL_SEC = 1.0
+
+# flush_curr_thread() gives up waiting on DSS after this long.
+_DSS_FLUSH_TIMEOUT_SEC = 5.0
+
 # Comment/Uncomment to start with fresh files or possibly append existing logs.
 try:
     shutil.rmtree(_DSS_LOG_DIR, ignore_errors=True)
@@ -175,6 +205,14 @@ AND msg_lvl NOT IN ('DBUG', 'INFO');
     # Add additional views here that can help inspect each subsystem separately.
 ]
 
+# Indices are created during init also, right after the lg36 table. Each one costs a bit on every insert, so only add
+# the ones your views really need.
+_DEEP_INDICES = [
+
+    # all the last session (*_ls) views look up rows by session_id.
+    """ CREATE INDEX IF NOT EXISTS idx_lg36_session ON lg36(session_id); """,
+]
+
 
 # ======================================================================================================================
 # ======================================================================================================================
@@ -190,7 +228,7 @@ AND msg_lvl NOT IN ('DBUG', 'INFO');
 # SQLite natively supports only the types TEXT, INTEGER, REAL, BLOB and NULL.
 # mid:              message id.
 # session_id:       unique id created at init time, therefore unique to each init.
-# unix_time:        unix time stamp with max available precision cast to string.
+# unix_time:        unix time stamp with max available precision.
 # msg_lvl:          log level of the msg. i.e. DBUG, INFO, WARN, ERRR, CRIT (yes all are 4 chars).
 # caller_filename:  reflection derived information on who made the log call.
 # caller_lineno:    reflection derived information on who made the log call.
@@ -200,18 +238,22 @@ _LG36_SCHEMA = """
 CREATE TABLE IF NOT EXISTS lg36(
     mid              INTEGER PRIMARY KEY AUTOINCREMENT,
     session_id       TEXT,
-    unix_time        TEXT,
+    unix_time        REAL,
     msg_lvl          TEXT,
     caller_filename  TEXT,
-    caller_lineno    TEXT,
+    caller_lineno    INTEGER,
     caller_funcname  TEXT,
     pname            TEXT,
-    pid              TEXT,
+    pid              INTEGER,
     tname            TEXT,
-    tid              TEXT,
+    tid              INTEGER,
     log_msg          TEXT);
 """
 
+# kept as a single constant string, so sqlite3's statement cache can keep reusing the same prepared statement.
+_LG36_INSERT = """ INSERT INTO lg36(session_id, unix_time, msg_lvl, caller_filename, caller_lineno, caller_funcname,
+pname, pid, tname, tid, log_msg) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) """
+
 # ANSI color sequences
 _ANSI_RED = "\u001b[31m"
 _ANSI_GREEN = "\u001b[32m"
@@ -236,13 +278,32 @@ class LGLVL(enum.Enum):
         return super().__str__()[6:]  # chopping i.e. "LGLVL.DBUG", to "DBUG"
 
 
+# the 4 char label saved in the msg_lvl column. __str__ builds a new string on each call, this is built once here.
+for _lvl in LGLVL:
+    _lvl._label = _lvl.name
+del _lvl
+
 # DSS runs in a daemonic thread with this name.
 _DSS_THREAD_NAME = 'data_sink_service'
 
 # A queue for the data sink service, dss runs on its own thread and will consume this queue, app threads can
 # produce to it via dbg,info,warn,... calls, objects put into it are either LOG_RECORD or meta request
+# It is a plain deque, append() and popleft() are atomic so producers never take a lock in the common case.
 _dssq = None
 
+# set by producers to wake up dss, when it may be waiting on an empty _dssq.
+_dssq_ev = None
+
+# the dss thread started during init.
+_dss_thread = None
+
+# held by dss while it is inside sqlite or writing to stdout, and by os.fork(). A fork in the middle of that would leave
+# the child with sqlite/io internal locks that are held by a thread that does not exist there.
+_dss_io_lock = threading.Lock()
+
+# unique id for this init, saved with every row. set during init.
+_SESSION_ID = None
+
 # not used often, just make sure in case of lazy init, you dont init in parallel.
 _lg36_initialized = False
 _lg36_init_lock = threading.Lock()
@@ -252,67 +313,135 @@ _lg36_init_lock = threading.Lock()
 _STDOUT_LVL_FILTER = None
 _DSS_LVL_FILTER = None
 
+# the same filters as plain ints (LGLVL values) for the per msg checks. a disabled sink gets a value above CRIT.
+_STDOUT_LVL_FILTER_INT = 0
+_DSS_LVL_FILTER_INT = 0
+
+# LGLVL value -> bitmask of the sinks that accept msgs at that level, built during init.
+_SINK_STDOUT = 1
+_SINK_DSS = 2
+_SINK_MASK = {}
+
+# lowest level value that at least one enabled sink would accept, set during init. log calls below it return right
+# away without building a log record. until init it stays 0, so nothing is skipped before the filters are known.
+_EFFECTIVE_MIN_LVL = 0
+
 
 # ======================================================================================================================
 # ======================================================================================================================
 # =========================================================================================================== Log Record
 # Log record generated by lg36
-@dataclass(frozen=True)
+# A plain class with __slots__ rather than a frozen dataclass. One is created for every log call, slots make it smaller
+# and a frozen dataclass pays for an object.__setattr__() call per field in __init__. Treat it as immutable anyway.
 class LOG_RECORD:
-    " An Immutable complete record generated for each logging message sent to lg36."
+    " A complete record generated for each logging message sent to lg36."
+
+    __slots__ = ('unix_time', 'msg_lvl', 'caller_filename', 'caller_lineno', 'caller_funcname', 'log_msg', 'pname',
+                 'pid', 'tname', 'tid')
 
-    unix_time: float
+    def __init__(self, unix_time: float, msg_lvl: LGLVL, caller_filename: str, caller_lineno: int,
+                 caller_funcname: str, log_msg: str, pname: str, pid: int, tname: str, tid: int):
 
-    # level attached to this log msg. i.e. if user said: log.dbg() then this is set to LGLVL.DEBUG
-    msg_lvl: LGLVL
+        self.unix_time = unix_time
 
-    # caller file name, line number and function name.
-    caller_filename: str
-    caller_lineno: str
-    caller_funcname: str
+        # level attached to this log msg. i.e. if user said: log.dbg() then this is set to LGLVL.DEBUG
+        self.msg_lvl = msg_lvl
 
-    # the log msg issued to lg36.
-    log_msg: str
+        # caller file name, line number and function name.
+        self.caller_filename = caller_filename
+        self.caller_lineno = caller_lineno
+        self.caller_funcname = caller_funcname
 
-    # process info
-    pname: str
-    pid: str
+        # the log msg issued to lg36.
+        self.log_msg = log_msg
 
-    # thread info
-    tname: str
-    tid: str
+        # process info
+        self.pname = pname
+        self.pid = pid
 
+        # thread info
+        self.tname = tname
+        self.tid = tid
 
-def _mk_lgr(msg_lvl, log_msg) -> LOG_RECORD:
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"LOG_RECORD({fields})"
+
+
+# per thread cache of (process, pid, thread, tid) for _mk_lgr.
+_tls = threading.local()
+
+
+def _reset_tls():
+    """ Drop the cached identities in a forked child, otherwise it keeps logging with the parent's pid. """
+
+    global _tls
+    _tls = threading.local()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_tls)
+
+
+def _mk_lgr(msg_lvl, log_msg, caller_info=None):
     """ Generate a complete log record. This function should be called immediately after a log msg was called on
     mnlogger. (i.e. after a log.dbg(), log.info(), log.warn() call took place). This is because this function
-    will look up the call stack to try and locate the stack frame of the function that issued the log call. """
+    will look up the call stack to try and locate the stack frame of the function that issued the log call.
 
-    # inspect docs: https://docs.python.org/3/library/inspect.html
-    # inspect.stack() returns a list of FrameInfo Objects, the first one (idx==0) belongs to this function itself
-    # _mk_lgr -> idx_0                      (this func)
-    # {dbg,info,warn,...} -> idx_1          (this func caller)
-    # lg36 user -> idx_2
-    tmp_inspect_res = inspect.stack()
-    caller_frame_info = tmp_inspect_res[2]
+    If caller_info is given, it must be a (caller_filename, caller_lineno, caller_funcname) tuple, and the call stack
+    is not looked at.
 
-    unix_time = time.time()
+    Returns None if no sink accepts msg_lvl. If only the dss sink does, returns the lg36 table row for it as a tuple
+    in _LG36_INSERT column order, thats all dss needs. Otherwise returns a LOG_RECORD. """
 
-    caller_filename = caller_frame_info.filename
-    caller_lineno = str(caller_frame_info.lineno)
-    caller_funcname = caller_frame_info.function
-    # caller_funcname = inspect.currentframe().f_back.f_back.f_code.co_name
+    # lazy init if needed, which sinks accept what is only known after init.
+    if not _lg36_initialized:
+        _lg36_internal_init()
 
-    # this is always going to the one line of code that looks like log.dbg('...')
-    # caller_code_cntxt = caller_frame_info.code_context
+    sinks = _SINK_MASK[msg_lvl.value]
+    if not sinks:
+        return None
 
-    cp = multiprocessing.current_process()
-    ct = threading.current_thread()
-    pname = cp.name
-    pid = str(cp.pid)
+    unix_time = time.time()
 
+    # the msg is formatted and written later on the dss thread, by then a mutable msg (i.e. a dict) may have changed.
+    # take its string form now, that is also a type sqlite can always bind. None stays None (NULL in the db).
+    if log_msg is not None and type(log_msg) is not str:
+        log_msg = str(log_msg)
+
+    if caller_info is None:
+        # sys._getframe(depth) returns the frame object depth calls up the stack, 0 being this function itself.
+        # _mk_lgr -> depth_0                    (this func)
+        # {dbg,info,warn,...} -> depth_1        (this func caller)
+        # lg36 user -> depth_2
+        # dont use inspect.stack() here, it builds a FrameInfo for every frame on the stack and reads source lines from
+        # disk for each of them, on every log call.
+        caller_frame = sys._getframe(2)
+
+        caller_filename = caller_frame.f_code.co_filename
+        caller_lineno = caller_frame.f_lineno
+        caller_funcname = caller_frame.f_code.co_name
+    else:
+        caller_filename, caller_lineno, caller_funcname = caller_info
+
+    # pid/tid dont change for the life of a thread, look them up once per thread. names can be changed at any time
+    # (i.e. thread.name = "worker-3"), so only the objects are cached and the names are read on every call.
+    tls = _tls
+    try:
+        cp, pid, ct, tid = tls.ident
+    except AttributeError:
+        cp = multiprocessing.current_process()
+        ct = threading.current_thread()
+        tls.ident = (cp, cp.pid, ct, ct.ident)
+        pid, tid = cp.pid, ct.ident
+
+    pname = cp.name
     tname = ct.name
-    tid = str(ct.ident)
+
+    # most records only go to dss (i.e. dbug msgs), skip building a LOG_RECORD just to be turned into a row later.
+    if sinks == _SINK_DSS:
+        return (_SESSION_ID, unix_time, msg_lvl._label, caller_filename, caller_lineno, caller_funcname, pname, pid,
+                tname, tid, log_msg)
 
     # Now Create the log record.
     lgr = LOG_RECORD(
@@ -335,29 +464,50 @@ def _mk_lgr(msg_lvl, log_msg) -> LOG_RECORD:
 # ======================================================================================================================
 # =============================================================================================================== Format
 # all formatting logic should be here. lg36 will use this.
-def _get_stdout_msg_fmt(lgr: LOG_RECORD) -> str:
 
-    # time_str = str(lgr.unix_time).ljust(18)  # at least 18 chars, does not shorten
-    # msg_builder = f"{time_str}|{lgr.caller_filename}:{lgr.caller_lineno}"
-    # msg_builder += f"|P:{lgr.pname}:{lgr.pid}|T:{lgr.tname}:{lgr.tid}|{lgr.log_msg}"
+# caller_filename -> its basename. bounded by the number of source files that make log calls, so no eviction needed.
+_BASENAME_CACHE = {}
+
+
+def _fast_basename(path: str) -> str:
+
+    bname = _BASENAME_CACHE.get(path)
+    if bname is None:
+        bname = os.path.basename(path)
+        _BASENAME_CACHE[path] = bname
+
+    return bname
+
 
-    fbasename = os.path.basename(lgr.caller_filename)
-    msg_builder = f"{int(lgr.unix_time)}|{fbasename}:{lgr.caller_lineno}|{lgr.log_msg}"
+# level tag (and color) put before/after each stdout msg, looked up once per msg instead of comparing to every level.
+_LVL_PREFIX = {
+    LGLVL.DBUG: 'DBUG|',
+    LGLVL.INFO: f'{_ANSI_GREEN}INFO|',
+    LGLVL.WARN: f'{_ANSI_BLUE}WARN|',
+    LGLVL.ERRR: f'{_ANSI_YELLOW}ERRR|',
+    LGLVL.CRIT: f'{_ANSI_RED}CRIT|',
+}
 
-    if lgr.msg_lvl == LGLVL.DBUG:
-        msg_builder = f'DBUG|{msg_builder}'
+_LVL_SUFFIX = {
+    LGLVL.DBUG: '',
+    LGLVL.INFO: _ANSI_RESET,
+    LGLVL.WARN: _ANSI_RESET,
+    LGLVL.ERRR: _ANSI_RESET,
+    LGLVL.CRIT: _ANSI_RESET,
+}
 
-    if lgr.msg_lvl == LGLVL.INFO:
-        msg_builder = f'{_ANSI_GREEN}INFO|{msg_builder}{_ANSI_RESET}'
 
-    if lgr.msg_lvl == LGLVL.WARN:
-        msg_builder = f'{_ANSI_BLUE}WARN|{msg_builder}{_ANSI_RESET}'
+def _get_stdout_msg_fmt(lgr: LOG_RECORD) -> str:
+
+    # time_str = str(lgr.unix_time).ljust(18)  # at least 18 chars, does not shorten
+    # msg_builder = f"{time_str}|{lgr.caller_filename}:{lgr.caller_lineno}"
+    # msg_builder += f"|P:{lgr.pname}:{lgr.pid}|T:{lgr.tname}:{lgr.tid}|{lgr.log_msg}"
 
-    if lgr.msg_lvl == LGLVL.ERRR:
-        msg_builder = f'{_ANSI_YELLOW}ERRR|{msg_builder}{_ANSI_RESET}'
+    prefix = _LVL_PREFIX[lgr.msg_lvl]
+    suffix = _LVL_SUFFIX[lgr.msg_lvl]
+    fbasename = _fast_basename(lgr.caller_filename)
 
-    if lgr.msg_lvl == LGLVL.CRIT:
-        msg_builder = f'{_ANSI_RED}CRIT|{msg_builder}{_ANSI_RESET}'
+    msg_builder = f"{prefix}{int(lgr.unix_time)}|{fbasename}:{lgr.caller_lineno}|{lgr.log_msg}{suffix}"
 
     return msg_builder
 
@@ -365,15 +515,46 @@ def _get_stdout_msg_fmt(lgr: LOG_RECORD) -> str:
 # ======================================================================================================================
 # ======================================================================================================================
 # ==================================================================================================== Data Sink Service
+@dataclass(frozen=True)
+class DSS_FLUSH_REQUEST:
+    " A meta request asking DSS to commit everything it has received so far, and then set done. "
+
+    done: threading.Event
+
+
 class DATA_SINK_SERVICE:
     def __init__(self):
 
         super().__init__()
 
-        # 4 bytes (32 bits) is already as big as IPv4. With 6 bytes, chance of collision is "2 to the -48"
-        self._session_id = str(os.urandom(6).hex())
+        # ********** batching
+        # lg36 table rows waiting to be written in the next transaction, formatted stdout lines waiting to be written in
+        # the next stdout write, and when the oldest of them arrived.
+        self._pending = []
+        self._stdout_pending = []
+        self._pending_since = 0.0
+
+        # ********** stdout
+        # turned off for good if a stdout write fails (i.e. a closed pipe), the db sink keeps going without it.
+        self._stdout_ok = True
 
         # ********** db connection
+        # dss thread also serves the stdout sink, the db is only needed if the dss sink itself is enabled. If the db
+        # can not be opened, keep going without it, stdout logging must not depend on it.
+        self._db_conn = None
+        if not _DSS_ENABLED:
+            return
+
+        try:
+            with _dss_io_lock:
+                self._open_db()
+        except Exception as ex:
+            self._db_conn = None
+            print(f"lg36 error: unable to open the dss db, continuing with stdout logging only. Exception: {ex}")
+
+    def _open_db(self):
+        """ Connect to the dss db and run the init statements (pragmas, schema, indices, views). """
+
         try:
             # make _DSS_LOG_DIR if not exists.
             Path(_DSS_LOG_DIR).resolve().mkdir(parents=True, exist_ok=True)
@@ -381,61 +562,215 @@ class DATA_SINK_SERVICE:
             # this is happening during init, print if something happens
             print(f'Error creating parent directory for lg36 db file: {ex}')
 
-        # Isolation_level=None means autocommit. IMO autocommit should be preferred, despite widespread misconceptions.
-        # Bad idea to keep transaction open unless you rly need them. Request one with BEGIN and COMMIT, if necessary.
-        self._db_conn = sqlite3.connect(str(_DSS_LOG_FILE), isolation_level=None)
-
-        cursr = self._db_conn.cursor()
+        # Isolation_level=None means autocommit, used for the init statements below, each one takes effect right away.
+        # cached_statements is the size of the per connection prepared statement cache.
+        self._db_conn = sqlite3.connect(str(_DSS_LOG_FILE), isolation_level=None, cached_statements=128)
 
         # ********** PRAGMA if any
         for prag in _SQLITE_PRAGMAS:
-            cursr.execute(prag)
+            self._db_conn.execute(prag)
 
         # ********** Schema
-        cursr.execute(_LG36_SCHEMA)
+        self._db_conn.execute(_LG36_SCHEMA)
+
+        # ********** deep indices
+        for deep_index in _DEEP_INDICES:
+            self._db_conn.execute(deep_index)
 
         # ********** deep views
         for deep_view in _DEEP_VIEWS:
-            cursr.execute(deep_view)
+            self._db_conn.execute(deep_view)
+
+        # ********** steady state
+        # From here on only batch inserts. Isolation_level="DEFERRED" means sqlite3 opens a transaction implicitly
+        # before an INSERT, and "with db_conn:" commits it (or rolls it back on error). Dont keep transactions open
+        # for long, the only one here lives for the duration of a batch write.
+        self._db_conn.isolation_level = "DEFERRED"
 
-        cursr.close()  # unnecessary but do it anyway
+    def _save_row(self, row: tuple):
+        """ Add the given lg36 table row to the pending batch. It is written to the log records table on the next
+        commit_pending() call. """
+
+        # no db to write to (failed to open during init), drop it.
+        if self._db_conn is None:
+            return
+
+        if not self.has_pending():
+            self._pending_since = time.monotonic()
+
+        self._pending.append(row)
 
     def _save_lgr(self, lgr: LOG_RECORD):
-        """ Save the given log record into the log records table."""
+        """ Same as _save_row(), for a log record. """
+
+        self._save_row((_SESSION_ID, lgr.unix_time, lgr.msg_lvl._label, lgr.caller_filename, lgr.caller_lineno,
+                        lgr.caller_funcname, lgr.pname, lgr.pid, lgr.tname, lgr.tid, lgr.log_msg))
+
+    def _print_lgr(self, lgr: LOG_RECORD):
+        """ Format the given log record for stdout and add it to the pending stdout lines. It is written to stdout on
+        the next commit_pending() call. """
+
+        # stdout is gone, drop it.
+        if not self._stdout_ok:
+            return
+
+        if not self.has_pending():
+            self._pending_since = time.monotonic()
+
+        self._stdout_pending.append(_get_stdout_msg_fmt(lgr=lgr))
 
-        cursr = self._db_conn.cursor()
+    def has_pending(self) -> bool:
+        return len(self._pending) > 0 or len(self._stdout_pending) > 0
 
-        query = """ INSERT INTO lg36(session_id, unix_time, msg_lvl, caller_filename, caller_lineno, caller_funcname,
-        pname, pid, tname, tid, log_msg) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) """
+    def commit_due(self) -> bool:
+        """ True if the pending batch is full or has been waiting long enough that it should be committed now. """
 
-        row = (self._session_id, str(lgr.unix_time), str(lgr.msg_lvl), lgr.caller_filename, lgr.caller_lineno,
-               lgr.caller_funcname, lgr.pname, lgr.pid, lgr.tname, lgr.tid, lgr.log_msg)
+        if not self.has_pending():
+            return False
 
-        cursr.execute(query, row)
+        if len(self._pending) >= _DSS_MAX_BATCH_SIZE or len(self._stdout_pending) >= _DSS_MAX_BATCH_SIZE:
+            return True
 
-        # not needed in sqlite, but do it anyway.
-        cursr.close()
+        return (time.monotonic() - self._pending_since) >= _DSS_MAX_COMMIT_INTERVAL_SEC
+
+    def write_stdout_pending(self):
+        """ Write all pending stdout lines to stdout in one write. Pending records are left for commit_pending(). """
+
+        lines = self._stdout_pending
+        self._stdout_pending = []
+
+        if not lines:
+            return
+
+        try:
+            with _dss_io_lock:
+                sys.stdout.write("\n".join(lines) + "\n")
+                sys.stdout.flush()
+
+        # OSError for a closed pipe (i.e. "| head"), ValueError for a closed sys.stdout. Either way it is not coming
+        # back, stop writing to it, but dont let it take the db sink down with it.
+        except (OSError, ValueError) as ex:
+            self._stdout_ok = False
+            _report_dss_error(f"stdout write failed, stdout logging is turned off. Exception: {ex}")
+
+    def commit_pending(self):
+        """ Write all pending stdout lines to stdout in one write, and all pending log records into the log records
+        table in a single transaction. """
+
+        # the batch is dropped if the write fails, dont want one bad batch to be retried forever.
+        rows = self._pending
+        self._pending = []
+
+        try:
+            self.write_stdout_pending()
+
+        finally:
+            if rows:
+                with _dss_io_lock:
+                    try:
+                        # one transaction (and with synchronous writes, one sync) per batch, not one per record.
+                        with self._db_conn:
+                            self._db_conn.executemany(_LG36_INSERT, rows)
+
+                    # a row sqlite can not bind (i.e. an unsupported type) fails the whole executemany, dont drop the
+                    # rest of the batch along with it.
+                    except (sqlite3.InterfaceError, sqlite3.ProgrammingError):
+                        self._commit_rows_one_by_one(rows)
+
+    def _commit_rows_one_by_one(self, rows: list):
+        """ Fallback for a batch that failed to bind. Write its rows one by one, still in a single transaction, and drop
+        only the ones that fail. """
+
+        dropped = 0
+        last_ex = None
+
+        with self._db_conn:
+            for row in rows:
+                try:
+                    self._db_conn.execute(_LG36_INSERT, row)
+                except (sqlite3.InterfaceError, sqlite3.ProgrammingError) as ex:
+                    dropped += 1
+                    last_ex = ex
+
+        if dropped:
+            _report_dss_error(f"dropped {dropped} records that could not be written to the db. Exception: {last_ex}")
 
     def process_req(self, req):
         """ Process a request that was sent to the DSS Queue. The request must be an instance of:
+        - tuple (an lg36 table row, for records that only go to the dss sink, see _mk_lgr())
         - LOG_RECORD
-        - DSS_META_REQUEST
+        - DSS_META_REQUEST (i.e. DSS_FLUSH_REQUEST)
         """
 
+        # ******************** lg36 table row
+        if isinstance(req, tuple):
+            self._save_row(req)
+
         # ******************** LOG_RECORD
-        if isinstance(req, LOG_RECORD):
-            self._save_lgr(req)
+        elif isinstance(req, LOG_RECORD):
+
+            sinks = _SINK_MASK[req.msg_lvl.value]
+
+            if sinks & _SINK_STDOUT:
+                self._print_lgr(req)
+
+                # see _DSS_MAX_COMMIT_INTERVAL_SEC, WARN and above dont wait for the batch.
+                if req.msg_lvl.value >= LGLVL.WARN.value:
+                    self.write_stdout_pending()
+
+            if sinks & _SINK_DSS:
+                self._save_lgr(req)
 
         # ******************** DSS_META_REQUEST
-        # NOTE: we might never really need this. I can only think of a flush() call from lg36 user needing
-        # to send meta request to DSS, but flush is already done automatically every few seconds.
-        # still we might add something else in the future, so here is a mechanism by which to send requests to
-        # the data sink service.
+        # Requests from lg36 itself, as opposed to log records from the app. i.e. flush_curr_thread() posts a flush
+        # request. The queue is in order, by the time dss sees it, every record posted before it is already pending.
+        elif isinstance(req, DSS_FLUSH_REQUEST):
+            try:
+                self.commit_pending()
+            finally:
+                req.done.set()
 
 
 # ======================================================================================================================
 # ======================================================================================================================
 # ======================================================================================================== DSS/LG36 INIT
+def _dssq_put(req):
+    """ Post a request to the dss queue. Called from app threads. """
+
+    _dssq.append(req)
+
+    # only pay for the wake up if dss may be waiting, when the event is already set dss hasnt started waiting yet.
+    if not _dssq_ev.is_set():
+        _dssq_ev.set()
+
+
+def _dssq_get(timeout):
+    """ Pop the next request from the dss queue, waiting up to timeout seconds (None means no limit) for one to show
+    up. Raises IndexError if the queue is still empty after that. Only called from the dss thread. """
+
+    try:
+        return _dssq.popleft()
+    except IndexError:
+        pass
+
+    # clear first then look at the queue again, so a request posted in between can not be missed.
+    _dssq_ev.clear()
+    if not _dssq:
+        _dssq_ev.wait(timeout)
+
+    return _dssq.popleft()
+
+
+def _report_dss_error(msg: str):
+    """ Report an error from the dss thread. Goes to stderr, stdout may well be what failed. Never raises, an error
+    here must not kill the dss thread. """
+
+    try:
+        print(f"lg36 error: {msg}", file=sys.__stderr__, flush=True)
+    except Exception:
+        pass
+
+
 def _dss_entry():
     """ Entry point for the data sink service daemon. This service will poll the dss queue for work and perform it. """
 
@@ -446,23 +781,42 @@ def _dss_entry():
     while True:
 
         try:
-            # block until an item is available
-            next_req = _dssq.get(block=True)
-        # except queue.Empty as ex:
-        except Exception as ex:
-            print(f"DSS Error: {ex}")
+            try:
+                if dss.has_pending():
+                    # keep draining the queue into the current batch, as long as it doesnt go quiet.
+                    next_req = _dssq_get(timeout=_DSS_DRAIN_WAIT_SEC)
+                else:
+                    # nothing to commit, block until an item is available
+                    next_req = _dssq_get(timeout=None)
+            except IndexError:
+                # queue went quiet, dont sit on a partially filled batch.
+                dss.commit_pending()
+                continue
+
+            # process next_req
+            dss.process_req(req=next_req)
+
+            if dss.commit_due():
+                dss.commit_pending()
 
-        # process next_req
-        dss.process_req(req=next_req)
+        except Exception as ex:
+            _report_dss_error(f"dss loop. Exception: {ex}")
 
 
 def _lg36_internal_init():
 
     global _dssq
+    global _dssq_ev
+    global _dss_thread
     global _lg36_init_lock
     global _lg36_initialized
     global _STDOUT_LVL_FILTER
     global _DSS_LVL_FILTER
+    global _STDOUT_LVL_FILTER_INT
+    global _DSS_LVL_FILTER_INT
+    global _EFFECTIVE_MIN_LVL
+    global _SINK_MASK
+    global _SESSION_ID
 
     # make sure, you dont do multiple inits concurrently on multiple threads
     with _lg36_init_lock:
@@ -474,16 +828,64 @@ def _lg36_internal_init():
             _STDOUT_LVL_FILTER = _string_2_lglvl(_STDOUT_LVL_FILTER_STRING)
             _DSS_LVL_FILTER = _string_2_lglvl(_DSS_LVL_FILTER_STRING)
 
+            # a disabled sink accepts nothing, so it counts as a filter above CRIT.
+            _STDOUT_LVL_FILTER_INT = _STDOUT_LVL_FILTER.value if _STDOUT_LOGGING_ENABLED else LGLVL.CRIT.value + 1
+            _DSS_LVL_FILTER_INT = _DSS_LVL_FILTER.value if _DSS_ENABLED else LGLVL.CRIT.value + 1
+            _EFFECTIVE_MIN_LVL = min(_STDOUT_LVL_FILTER_INT, _DSS_LVL_FILTER_INT)
+
+            _SINK_MASK = {
+                lvl.value: ((_SINK_STDOUT if lvl.value >= _STDOUT_LVL_FILTER_INT else 0)
+                            | (_SINK_DSS if lvl.value >= _DSS_LVL_FILTER_INT else 0))
+                for lvl in LGLVL
+            }
+
             # ******************** dss init
-            _dssq = queue.Queue()
-            t = threading.Thread(target=_dss_entry, name=_DSS_THREAD_NAME)
-            t.setDaemon(True)
-            t.start()
+            # 4 bytes (32 bits) is already as big as IPv4. With 6 bytes, chance of collision is "2 to the -48"
+            _SESSION_ID = str(os.urandom(6).hex())
+
+            _dssq = collections.deque()
+            _dssq_ev = threading.Event()
+            _dss_thread = threading.Thread(target=_dss_entry, name=_DSS_THREAD_NAME)
+            _dss_thread.setDaemon(True)
+            _dss_thread.start()
+
+            # multiprocessing children leave through os._exit(), which skips atexit (see flush_curr_thread below). They
+            # run multiprocessing's own exit finalizers before that, flush from there too. Registered per init, a
+            # forked child starts with the registry cleared and inits again.
+            multiprocessing.util.Finalize(None, flush_curr_thread, exitpriority=0)
 
             # set the init flag to true, so it doesnt init again (unless someone cleared it knowingly)
             _lg36_initialized = True
 
 
+def _lg36_reset_after_fork():
+    """ A forked child inherits lg36's init state but not the dss thread, nothing would ever read its queue. Clear the
+    init flag, so the child inits lg36 again (own session, own dss thread) on its first log call. """
+
+    global _lg36_initialized
+    global _lg36_init_lock
+    global _dss_io_lock
+
+    # the locks could have been held by another thread of the parent at fork time, they would never be released here.
+    _lg36_init_lock = threading.Lock()
+    _dss_io_lock = threading.Lock()
+    _lg36_initialized = False
+
+
+def _dss_io_lock_acquire():
+    _dss_io_lock.acquire()
+
+
+def _dss_io_lock_release():
+    _dss_io_lock.release()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(before=_dss_io_lock_acquire,
+                        after_in_parent=_dss_io_lock_release,
+                        after_in_child=_lg36_reset_after_fork)
+
+
 # ======================================================================================================================
 # ======================================================================================================================
 # ============================================================================================================== Utility
@@ -510,27 +912,20 @@ def _string_2_lglvl(lvl_str: str) -> LGLVL:
     return LGLVL.DBUG
 
 
-def _process_lgr(lgr: LOG_RECORD):
-
-    # lazy init if needed
-    if not _lg36_initialized:
-        _lg36_internal_init()
+def _process_lgr(lgr):
+    """ Hand over what _mk_lgr() made to the dss thread. Both sinks (stdout and sqlite) are served from there, it
+    formats and writes in batches. """
 
-    # **************************************** stdout sink
-    if _STDOUT_LOGGING_ENABLED and (lgr.msg_lvl.value >= _STDOUT_LVL_FILTER.value):
+    # no sink wants this msg.
+    if lgr is None:
+        return
 
-        fmt_msg_str = _get_stdout_msg_fmt(lgr=lgr)
-        print(fmt_msg_str)  # print good enof for stdout.
-
-    # **************************************** dss sink
-    if _DSS_ENABLED and (lgr.msg_lvl.value >= _DSS_LVL_FILTER.value):
-
-        # post it into the dss queue. Dont want logging to crash the application even if something goes wrong
-        # later at runtime. Ignore the errors if they arise, but maybe print something to stdout.
-        try:
-            _dssq.put_nowait(lgr)
-        except Exception as ex:
-            print(f"lg36 error: unable to write to dss queue. Exception: {ex}")
+    # post it into the dss queue. Dont want logging to crash the application even if something goes wrong
+    # later at runtime. Ignore the errors if they arise, but maybe print something to stdout.
+    try:
+        _dssq_put(lgr)
+    except Exception as ex:
+        print(f"lg36 error: unable to write to dss queue. Exception: {ex}")
 
 
 # ======================================================================================================================
@@ -538,34 +933,61 @@ def _process_lgr(lgr: LOG_RECORD):
 # ==================================================================================================== lg36 exported API
 def dbg(msg=None):
 
+    if LGLVL.DBUG.value < _EFFECTIVE_MIN_LVL:
+        return
+
     lgr = _mk_lgr(msg_lvl=LGLVL.DBUG, log_msg=msg)
     _process_lgr(lgr)
 
 
 def info(msg=None):
 
+    if LGLVL.INFO.value < _EFFECTIVE_MIN_LVL:
+        return
+
     lgr = _mk_lgr(msg_lvl=LGLVL.INFO, log_msg=msg)
     _process_lgr(lgr)
 
 
 def warn(msg=None):
 
+    if LGLVL.WARN.value < _EFFECTIVE_MIN_LVL:
+        return
+
     lgr = _mk_lgr(msg_lvl=LGLVL.WARN, log_msg=msg)
     _process_lgr(lgr)
 
 
 def err(msg=None):
 
+    if LGLVL.ERRR.value < _EFFECTIVE_MIN_LVL:
+        return
+
     lgr = _mk_lgr(msg_lvl=LGLVL.ERRR, log_msg=msg)
     _process_lgr(lgr)
 
 
 def crit(msg=None):
 
+    if LGLVL.CRIT.value < _EFFECTIVE_MIN_LVL:
+        return
+
     lgr = _mk_lgr(msg_lvl=LGLVL.CRIT, log_msg=msg)
     _process_lgr(lgr)
 
 
+def log_raw(lvl: LGLVL, msg=None, caller_filename="", caller_lineno=0, caller_funcname=""):
+    """ Like dbg(), info(), ... but the caller info is whatever is passed in, lg36 wont look up the call stack for it.
+    Meant for very hot loops, where the caller info is either known already or not worth paying for. i.e.:
+    log.log_raw(log.LGLVL.DBUG, f'step {i}', __file__) """
+
+    if lvl.value < _EFFECTIVE_MIN_LVL:
+        return
+
+    lgr = _mk_lgr(msg_lvl=lvl, log_msg=msg, caller_info=(caller_filename, caller_lineno, caller_funcname))
+    _process_lgr(lgr)
+
+
 def init_lg36(init_conf=None):
     """ Optional init call to let lg36 know it can go ahead and init itself now. If this call is never made, lg36
     would initialize lazily as necessary.
@@ -579,17 +1001,26 @@ def init_lg36(init_conf=None):
     _lg36_internal_init()
 
 
-def flush_curr_thread():
+def flush_curr_thread() -> bool:
+    """ Block until all log msgs issued so far by the current thread are written to stdout and the DSS db, or until
+    _DSS_FLUSH_TIMEOUT_SEC passes. Returns True if they were flushed, False if it timed out or DSS is not running. """
+
+    # nothing was logged yet, nothing to flush.
+    if not _lg36_initialized:
+        return True
+
+    # dss has died, whatever is in its queue is not going anywhere.
+    if not _dss_thread.is_alive():
+        return False
 
-    # TODO The correct flush implementation would be:
-    # - generate a random string called sentinel.
-    # - post the sentinel to the dssq as a meta request, not a log record.
-    # - DSS, upon seeing a sentinel would add it to a global set. thats it just a set.
-    # - sleep wait and poll that set here, until it shows up. once it shows up, discard it from the set, return
-    # to user current threads msgs must have all been seen by the DSS, therefore we are flushed out.
+    # dss processes the queue in order, by the time it sees this request, it has seen all of this threads msgs.
+    flush_req = DSS_FLUSH_REQUEST(done=threading.Event())
+    _dssq_put(flush_req)
+    return flush_req.done.wait(timeout=_DSS_FLUSH_TIMEOUT_SEC)
 
-    # a crude alternative
-    time.sleep(0.3)
+
+# dss is daemonic, it gets killed at interpreter exit. get whatever it is still holding out before that.
+atexit.register(flush_curr_thread)
 
 
 # ======================================================================================================================
@@ -665,16 +1096,15 @@ def dump_lg36_knobs():
 
 def dump_lg36():
 
-    flush_curr_thread()
+    if not flush_curr_thread():
+        print("lg36 warning: flush did not complete, the dump below may be missing recent msgs.")
 
     view_name = "lg36"
     print(f"\n# {_SEP_LINE}>>>>> {view_name}: ")
 
     try:
         db_conn = _get_ro_db_conn_if_possible()
-        cursr = db_conn.execute(f'SELECT * FROM {view_name};')
-
-        rows = cursr.fetchall()
+        rows = db_conn.execute(f'SELECT * FROM {view_name};').fetchall()
         for row in rows:
             print(_db_row_to_string(row))
 